@@ -21,7 +21,7 @@
 Tool for downloading IceBridge data
 '''
 
-import sys, os, re, subprocess, optparse, logging
+import sys, os, re, subprocess, optparse, logging, socket, functools, bisect, glob
 import icebridge_common
 import httplib
 from urlparse import urlparse
@@ -37,7 +37,7 @@ sys.path.insert(0, basepath) # prepend to Python path
 sys.path.insert(0, pythonpath)
 sys.path.insert(0, libexecpath)
 
-import asp_system_utils
+import asp_system_utils, asp_file_utils
 
 asp_system_utils.verify_python_version_is_supported()
 
@@ -50,23 +50,105 @@ os.environ["PATH"] = basepath    + os.pathsep + os.environ["PATH"]
 # Constants
 LIDAR_TYPES = ['atm1', 'atm2', 'lvis']
 MAX_IN_ONE_CALL = 100 # when fetching in batches
+NUM_DOWNLOAD_THREADS = 8 # how many batches to fetch at the same time
+MAX_PARALLEL_TRANSFERS = 16 # total over all batches, if curl supports -Z
+NUM_VALIDATION_THREADS = 4 # how many files to checksum at the same time
+
+# Regular expressions to find the file names for each data type in an index.html file.
+# The group captures the file name without the surrounding '>' and '<'.
+FILE_PATTERNS = {
+    'jpeg':     re.compile(r">([0-9_]*.JPG)", re.IGNORECASE),
+    'ortho':    re.compile(r">(DMS\w*.tif)<", re.IGNORECASE),
+    'fireball': re.compile(r">(IODMS\w*DEM.tif)", re.IGNORECASE), # Fireball DEMs
+    'lvis':     re.compile(r">(ILVIS\w+.TXT)", re.IGNORECASE),
+    #                        >ILATM1B_20111018_145455.ATM4BT4.qi
+    #   or                   >ILATM1B_20091016_165112.atm4cT3.qi
+    'atm1':     re.compile(r">(ILATM1B[0-9_]*.ATM4\w+.qi)", re.IGNORECASE),
+    # Match ILATM1B_20160713_195419.ATM5BT5.h5 
+    'atm2':     re.compile(r">(ILATM1B[0-9_]*.ATM\w+.h5)", re.IGNORECASE)
+    }
+
+# Where each data type is kept. The nav and jpeg folders are
+# organized differently and are handled separately.
+BASE_URLS = {
+    'ortho':    'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/IODMS1B.001',
+    'fireball': 'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/IODMS3.001',
+    'atm1':     'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/ILATM1B.001/',
+    'atm2':     'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/ILATM1B.002/',
+    'lvis':     'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/ILVIS2.001/'
+    }
+
+# Open HTTPS connections, one per host. Reusing them avoids
+# a new TLS handshake for each HEAD request.
+connectionCache = {}
 
 def checkIfUrlExists(url):
     '''Return true if the given IceBrige folder URL is valid'''
-    p    = urlparse(url)
-    conn = httplib.HTTPConnection(p.netloc)
-    conn.request('HEAD', p.path)
-    resp = conn.getresponse()
+    p = urlparse(url)
+
+    # A cached connection may have been closed by the server in the meantime,
+    # so if the request fails, try once more with a fresh connection.
+    for attempt in range(2):
+        conn = connectionCache.pop(p.netloc, None)
+        if conn is None:
+            conn = httplib.HTTPSConnection(p.netloc, timeout=10)
+        try:
+            conn.request('HEAD', p.path)
+            resp = conn.getresponse()
+            resp.read() # must drain the response before the connection can be reused
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if attempt > 0:
+                raise
+            continue
+        break
+
+    if resp.will_close:
+        conn.close()
+    else:
+        connectionCache[p.netloc] = conn
     
     # Invalid pages return 404, valid pages should return one of the numbers below.
+    # Over HTTPS a valid folder may also redirect to the login page.
     # This is not robust enough!
     
-    return (resp.status == 403) or (resp.status == 301)
+    return resp.status in [200, 301, 302, 303, 307, 403]
+
+def memoize(func):
+    '''Cache the results of a function whose arguments are all hashable.
+       Python 2 has no functools.lru_cache.'''
+    cache = {}
+    @functools.wraps(func)
+    def wrapper(*args):
+        if args not in cache:
+            cache[args] = func(*args)
+        return cache[args]
+    return wrapper
+
+@memoize
+def curlSupportsParallel(curlPath):
+    '''Return true if curl can do parallel transfers with -Z. That needs curl 7.66.'''
+    try:
+        ver = asp_system_utils.get_prog_version(curlPath)
+        return [int(v) for v in ver.split('.')[0:2]] >= [7, 66]
+    except:
+        return False
 
+def curlBatchArgs(baseCurlArgs, numDownloadThreads):
+    '''The curl arguments for fetching a batch of files with -O. Let newer curl
+    fetch the files in a batch in parallel. Several batches run at the same
+    time as well, so split the transfers among them.'''
+    if not curlSupportsParallel(baseCurlArgs[0]):
+        return baseCurlArgs
+    parallelMax = max(1, MAX_PARALLEL_TRANSFERS / max(1, numDownloadThreads))
+    return baseCurlArgs + ['-Z', '--parallel-max', str(parallelMax)]
+
+@memoize
 def makeYearFolder(year, site):
     '''Generate part of the URL.  Only used for images.'''
     return str(year) + '_' + site + '_NASA'
 
+@memoize
 def makeDateFolder(year, month, day, ext, fileType):
     '''Generate part of the URL.'''
 
@@ -77,6 +159,13 @@ def makeDateFolder(year, month, day, ext, fileType):
         datePart = ('%04d.%02d.%02d%s') % (year, month, day, ext)
         return datePart
 
+def folderPrefix(folder):
+    '''Return the folder with a trailing slash, so that file names can
+       simply be appended to it. Same as os.path.join, but cheaper in loops.'''
+    if folder == '' or folder.endswith('/'):
+        return folder
+    return folder + '/'
+
 def hasGoodLat(latitude, isSouth):
     '''Return true if latitude and isSouth parameters match.'''
     if (isSouth and latitude < 0) or ( (not isSouth) and latitude > 0 ):
@@ -84,72 +173,46 @@ def hasGoodLat(latitude, isSouth):
     return False
 
 def fetchAndParseIndexFileAux(isSouth, separateByLat, dayVal,
-                              baseCurlCmd, folderUrl, path, fileType):
+                              baseCurlArgs, folderUrl, outputFolder, fileType,
+                              numDownloadThreads):
     '''Retrieve the index file for a folder of data and create
     a parsed version of it that contains frame number / filename pairs.'''
 
-    # Download the html file
-    curlCmd = baseCurlCmd + ' ' + folderUrl + ' > ' + path
-    logger.info(curlCmd)
-    p = subprocess.Popen(curlCmd, shell=True)
-    os.waitpid(p.pid, 0)
+    # Read the html file straight from curl, without saving it to disk
+    curlCmd = baseCurlArgs + [folderUrl]
+    logger.info(" ".join(curlCmd))
+    p = subprocess.Popen(curlCmd, stdout=subprocess.PIPE)
+    indexText = p.communicate()[0]
 
-    # Find all the file names in the index file and
-    #  dump them to a new index file
+    # Find all the file names in the index file
     logger.info('Extracting file name list from index.html file...')
-    with open(path, 'r') as f:
-        indexText = f.read()
-
-    # Must wipe this html file. We fetch it too often in different
-    # contexts.  If not wiped, the code fails to work in some
-    # very rare but real situations.
-    if os.path.exists(path):
-        os.remove(path)
     
     # Extract just the file names
     fileList = [] # ensure initialization
-    if fileType == 'jpeg':
-        fileList = re.findall(">[0-9_]*.JPG", indexText, re.IGNORECASE)
-    if fileType == 'ortho':
-        fileList = re.findall(">DMS\w*.tif<", indexText, re.IGNORECASE) 
-    if fileType == 'fireball':
-        # Fireball DEMs
-        fileList = re.findall(">IODMS\w*DEM.tif", indexText, re.IGNORECASE)
-    if fileType == 'lvis':
-        fileList = re.findall(">ILVIS\w+.TXT", indexText, re.IGNORECASE)
-    if fileType == 'atm1':
-        fileList = re.findall(">ILATM1B[0-9_]*.ATM4\w+.qi", indexText, re.IGNORECASE)
-        #                      >ILATM1B_20111018_145455.ATM4BT4.qi
-        #   or                 >ILATM1B_20091016_165112.atm4cT3.qi
-    if fileType == 'atm2':
-        # Match ILATM1B_20160713_195419.ATM5BT5.h5 
-        fileList = re.findall(">ILATM1B[0-9_]*.ATM\w+.h5", indexText, re.IGNORECASE)
-
-    # Get rid of '>' and '<'
-    for fileIter in range(len(fileList)):
-        fileList[fileIter] = fileList[fileIter].replace(">", "")
-        fileList[fileIter] = fileList[fileIter].replace("<", "")
+    if fileType in FILE_PATTERNS:
+        fileList = FILE_PATTERNS[fileType].findall(indexText)
 
     # Some runs, eg, https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/IODMS1B.001/2015.09.24
     # have files for both GR and AN, with same frame number. Those need to be separated
     # by latitude. This is a problem only with orthoimages.
     badXmls = set()
-    outputFolder = os.path.dirname(path)
     if separateByLat:
         allFilesToFetch = []
         allUrlsToFetch  = []
+        urlPrefix = folderPrefix(folderUrl)
+        outPrefix = folderPrefix(outputFolder)
         for filename in fileList:
             xmlFile  = icebridge_common.xmlFile(filename)
-            url      = os.path.join(folderUrl, xmlFile)
-            outputPath = os.path.join(outputFolder, xmlFile)
+            url      = urlPrefix + xmlFile
+            outputPath = outPrefix + xmlFile
             allFilesToFetch.append(outputPath)
             allUrlsToFetch.append(url)
             
         dryRun = False
-        icebridge_common.fetchFilesInBatches(baseCurlCmd, MAX_IN_ONE_CALL,
-                                             dryRun, outputFolder,
+        icebridge_common.fetchFilesInBatches(curlBatchArgs(baseCurlArgs, numDownloadThreads),
+                                             MAX_IN_ONE_CALL, dryRun, outputFolder,
                                              allFilesToFetch, allUrlsToFetch,
-                                             logger)
+                                             logger, numDownloadThreads)
 
         # Mark the bad ones
         for xmlFile in allFilesToFetch:
@@ -252,6 +315,7 @@ def twoFlightsInOneDay(site, yyyymmdd):
     
     return False
 
+@memoize
 def getFolderUrl(yyyymmdd, year, month, day,
                  dayInc, # if to add one to the day
                  site, fileType):
@@ -289,18 +353,9 @@ def getFolderUrl(yyyymmdd, year, month, day,
     if twoFlightsInOneDay(site, yyyymmdd):
         dayInc = 0 # for this particular day, one should not look at the next day
         
-    if fileType == 'ortho':
-        base = 'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/IODMS1B.001'       
-    elif fileType == 'fireball':
-        base = 'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/IODMS3.001'
-    elif fileType == 'atm1':
-        base = 'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/ILATM1B.001/'
-    elif fileType == 'atm2':
-        base = 'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/ILATM1B.002/'
-    elif fileType == 'lvis':
-        base = 'https://n5eil01u.ecs.nsidc.org/ICEBRIDGE/ILVIS2.001/'
-    else:
-        raise("Unknown type: " + fileType)
+    if fileType not in BASE_URLS:
+        raise Exception("Unknown type: " + fileType)
+    base = BASE_URLS[fileType]
     
     dateFolder = makeDateFolder(year, month, day + dayInc, ext, fileType)
     folderUrl  = os.path.join(base, dateFolder)
@@ -308,7 +363,7 @@ def getFolderUrl(yyyymmdd, year, month, day,
     return folderUrl
 
 
-def fetchAndParseIndexFile(options, isSouth, baseCurlCmd, outputFolder):
+def fetchAndParseIndexFile(options, isSouth, baseCurlArgs, outputFolder):
     '''Create a list of all files that must be fetched unless done already.'''
 
     # For AN 20091112, etc, some of the ortho images are stored at the
@@ -340,14 +395,10 @@ def fetchAndParseIndexFile(options, isSouth, baseCurlCmd, outputFolder):
     if fetchNextDay:
         dayVals.append(1)
 
-    indexPath       = icebridge_common.htmlIndexFile(outputFolder)
-    
-    currIndexPath   = indexPath
     parsedIndexPath = icebridge_common.csvIndexFile(outputFolder)
 
     if options.refetchIndex:
-        os.system('rm -f ' + indexPath)
-        os.system('rm -f ' + parsedIndexPath)
+        asp_file_utils.removeIfExists(parsedIndexPath)
 
     if icebridge_common.fileNonEmpty(parsedIndexPath):
         logger.info('Already have the index file ' + parsedIndexPath + ', keeping it.')
@@ -378,11 +429,6 @@ def fetchAndParseIndexFile(options, isSouth, baseCurlCmd, outputFolder):
             
     for dayVal in dayVals:
 
-        if len(dayVals) > 1:
-            currIndexPath = indexPath + '.day' + str(dayVal)
-            if options.refetchIndex:
-                os.system('rm -f ' + currIndexPath)
-            
         # Find folderUrl which contains all of the files
         if options.type in LIDAR_TYPES:
             options.allFrames = True # For lidar, always get all the frames!
@@ -420,19 +466,19 @@ def fetchAndParseIndexFile(options, isSouth, baseCurlCmd, outputFolder):
                     (localFrameDict, localUrlDict) = \
                                      fetchAndParseIndexFileAux(isSouth,
                                                                separateByLat, dayVal,
-                                                               baseCurlCmd, folderUrl,
-                                                               currIndexPath,
-                                                               lidar_types[count])
+                                                               baseCurlArgs, folderUrl,
+                                                               outputFolder,
+                                                               lidar_types[count],
+                                                               options.numDownloadThreads)
                     for frame in sorted(localFrameDict.keys()):
                         filename = localFrameDict[frame]
                         xmlFile  = icebridge_common.xmlFile(filename)
                         url      = os.path.join(folderUrl, xmlFile)
                                         
                         # Download the file
-                        curlCmd = baseCurlCmd + ' ' + url + ' > ' + xmlFile
-                        logger.info(curlCmd)
-                        p = subprocess.Popen(curlCmd, shell=True)
-                        os.waitpid(p.pid, 0)
+                        curlCmd = baseCurlArgs + ['-o', xmlFile, url]
+                        logger.info(" ".join(curlCmd))
+                        subprocess.call(curlCmd)
                         
                         latitude = icebridge_common.parseLatitude(xmlFile)
                         if os.path.exists(xmlFile): os.remove(xmlFile)
@@ -469,8 +515,9 @@ def fetchAndParseIndexFile(options, isSouth, baseCurlCmd, outputFolder):
         (localFrameDict, localUrlDict) = \
                          fetchAndParseIndexFileAux(isSouth,
                                                    separateByLat, dayVal,
-                                                   baseCurlCmd, folderUrl,
-                                                   currIndexPath, options.type)
+                                                   baseCurlArgs, folderUrl,
+                                                   outputFolder, options.type,
+                                                   options.numDownloadThreads)
 
         # Append to the main index
         for frame in sorted(localFrameDict.keys()):
@@ -573,7 +620,7 @@ def validateNavOrWipe(filename, logger):
     m = re.match("^.*?DOCTYPE\s+HTML", line)
     if m:
         logger.info("Bad nav data, will wipe: " + filename)
-        os.system("rm -f " + filename)
+        asp_file_utils.removeIfExists(filename)
         return False
     
     return True
@@ -603,9 +650,9 @@ def fetchNavData(options, outputFolder):
     fileList = [filename, filenameA, filenameB]
     
     if options.refetchNav:
-        cmd = "rm -f " + os.path.join(outputFolder, "sbet_*")
-        print(cmd)
-        os.system(cmd)
+        for navFile in glob.glob(os.path.join(outputFolder, "sbet_*")):
+            print("Removing: " + navFile)
+            asp_file_utils.removeIfExists(navFile)
      
     # Download the files    
     for f in fileList:
@@ -644,20 +691,19 @@ def doFetch(options, outputFolder):
                      'downloading-data-https-earthdata-login-enabled')
         return -1
     
-    curlPath = asp_system_utils.which("curl")
-    curlOpts    = ' -n -L '
-    cookiePaths = ' -b ~/.urs_cookies -c ~/.urs_cookies '
-    baseCurlCmd = curlPath + curlOpts + cookiePaths
+    curlPath   = asp_system_utils.which("curl")
+    cookiePath = home + '/.urs_cookies'
+    baseCurlArgs = [curlPath, '-n', '-L', '-b', cookiePath, '-c', cookiePath]
 
     logger.info('Creating output folder: ' + outputFolder)
-    os.system('mkdir -p ' + outputFolder)  
+    asp_system_utils.mkdir_p(outputFolder)
 
     isSouth = (options.site == 'AN')
     
     if options.type == 'nav': # Nav fetching is much less complicated
         return fetchNavData(options, outputFolder)
     
-    parsedIndexPath = fetchAndParseIndexFile(options, isSouth, baseCurlCmd, outputFolder)
+    parsedIndexPath = fetchAndParseIndexFile(options, isSouth, baseCurlArgs, outputFolder)
     if not icebridge_common.fileNonEmpty(parsedIndexPath):
         # Some dirs are weird, both images, fireball dems, and ortho.
         # Just accept whatever there is, but with a warning.
@@ -672,7 +718,7 @@ def doFetch(options, outputFolder):
         # We probably ran into old format index file. Must refetch.
         logger.info('Could not read index file. Try again.')
         options.refetchIndex = True
-        parsedIndexPath = fetchAndParseIndexFile(options, isSouth, baseCurlCmd, outputFolder)
+        parsedIndexPath = fetchAndParseIndexFile(options, isSouth, baseCurlArgs, outputFolder)
         (frameDict, urlDict) = icebridge_common.readIndexFile(parsedIndexPath)
 
     if options.stopAfterIndexFetch:
@@ -686,11 +732,10 @@ def doFetch(options, outputFolder):
         # The lidar frames use a totally different numbering than the image/ortho/dem frames
         firstFrame = icebridge_common.getLargestFrame()    # start big
         lastFrame  = icebridge_common.getSmallestFrame()   # start small
-        for frameNumber in allFrames:
-            if frameNumber < firstFrame:
-                firstFrame = frameNumber
-            if frameNumber > lastFrame:
-                lastFrame = frameNumber
+        if len(allFrames) > 0:
+            # The frames are sorted
+            firstFrame = allFrames[0]
+            lastFrame  = allFrames[-1]
 
         if options.allFrames:
             options.startFrame = firstFrame
@@ -730,15 +775,20 @@ def doFetch(options, outputFolder):
     hasXml = ( isLidar or (options.type == 'ortho') or hasTfw )
     numFetched = 0
     skipCount  = 0
-    for frame in allFrames:
+    outPrefix  = folderPrefix(outputFolder)
 
-        # Skip frame outside of range
-        if isLidar:
-            if frameDict[frame] not in lidarsToFetch:
-                continue
-        else:       
-            if ((frame < options.startFrame) or (frame > options.stopFrame) ):
-                continue
+    # The frames are sorted, so jump directly to the requested range
+    framesInRange = allFrames
+    if not isLidar:
+        startIndex = bisect.bisect_left (allFrames, options.startFrame)
+        stopIndex  = bisect.bisect_right(allFrames, options.stopFrame)
+        framesInRange = allFrames[startIndex:stopIndex]
+        
+    for frame in framesInRange:
+
+        # Skip lidar files not needed for the frame range
+        if isLidar and (frameDict[frame] not in lidarsToFetch):
+            continue
                 
         # Handle the frame skip option
         if options.frameSkip > 0: 
@@ -756,9 +806,10 @@ def doFetch(options, outputFolder):
         if hasTfw: 
             currFilesToFetch.append(icebridge_common.tfwFile(filename))
 
+        urlPrefix = folderPrefix(urlDict[frame])
         for filename in currFilesToFetch:    
-            url        = os.path.join(urlDict[frame], filename)
-            outputPath = os.path.join(outputFolder, filename)
+            url        = urlPrefix + filename
+            outputPath = outPrefix + filename
             allFilesToFetch.append(outputPath)
             allUrlsToFetch.append(url)
 
@@ -773,9 +824,10 @@ def doFetch(options, outputFolder):
         allFilesToFetch = allFilesToFetch[0:options.maxNumLidarToFetch]
         allUrlsToFetch  = allUrlsToFetch [0:options.maxNumLidarToFetch]
                 
-    icebridge_common.fetchFilesInBatches(baseCurlCmd, MAX_IN_ONE_CALL, options.dryRun,
-                                         outputFolder,
-                                         allFilesToFetch, allUrlsToFetch, logger)
+    icebridge_common.fetchFilesInBatches(curlBatchArgs(baseCurlArgs, options.numDownloadThreads),
+                                         MAX_IN_ONE_CALL, options.dryRun, outputFolder,
+                                         allFilesToFetch, allUrlsToFetch, logger,
+                                         options.numDownloadThreads)
 
     # Fetch from disk the set of already validated files, if any
     validFilesList = icebridge_common.validFilesList(os.path.dirname(outputFolder),
@@ -783,41 +835,78 @@ def doFetch(options, outputFolder):
     validFilesSet = set()
     validFilesSet = icebridge_common.updateValidFilesListFromDisk(validFilesList, validFilesSet)
     numInitialValidFiles = len(validFilesSet)
+
+    # The size and modification time of each file when it was validated.
+    # Files changed since then will be validated again. Files with no
+    # record, such as after a run over a different frame range that
+    # was not merged, are trusted if they exist.
+    manifestFile = icebridge_common.validManifestFile(os.path.dirname(outputFolder),
+                                                      options.startFrame, options.stopFrame)
+    manifest = icebridge_common.readValidManifest(manifestFile)
     
     # Verify that all files were fetched and are in good shape
     failedFiles = []
+    folderListing = icebridge_common.listFolder(outputFolder)
+
+    # Stat each file once, and find the ones validated before.
+    # Computing the checksums is the bulk of the validation I/O, so do it
+    # up front for all files that need it, in parallel.
+    currStats       = {} # [size, mtime] of the files on disk
+    previouslyValid = set()
+    newStats        = {} # for the files validated in this run
+    chkSumFiles     = []
+    if not options.skipValidate:
+        for outputPath in allFilesToFetch:
+            stats = icebridge_common.fileStatsInListing(outputPath, folderListing)
+            if stats is None:
+                continue
+            currStats[outputPath] = stats
+            if icebridge_common.isPreviouslyValidated(outputPath, stats,
+                                                      validFilesSet, manifest):
+                previouslyValid.add(outputPath)
+                continue
+            extension = icebridge_common.fileExtension(outputPath)
+            if hasXml and extension not in ('.xml', '.tfw') and stats[0] > 0:
+                chkSumFiles.append(outputPath)
+    chkSumResults = icebridge_common.hasValidChkSumInParallel(chkSumFiles,
+                                                              NUM_VALIDATION_THREADS,
+                                                              logger)
+    
     for outputPath in allFilesToFetch:
 
         if options.skipValidate:
             continue
         
-        if not icebridge_common.fileNonEmpty(outputPath):
+        stats = currStats.get(outputPath)
+        if stats is None or stats[0] == 0:
             logger.info('Missing file: ' + outputPath)
             failedFiles.append(outputPath)
             continue
 
-        if icebridge_common.hasImageExtension(outputPath):
-            if False:
-                # This check is just so slow. Turn it off for now.
-                # This will impact only the validation of jpegs,
-                # as the other files can be validated via the checksum.
-                # Jpegs will be validated when converting them to 1 band images
-                if outputPath in validFilesSet and os.path.exists(outputPath):
-                    #logger.info('Previously validated: ' + outputPath)   # verbose
+        extension = icebridge_common.fileExtension(outputPath)
+
+        # The image check is just so slow. Turn it off for now.
+        # This will impact only the validation of jpegs,
+        # as the other files can be validated via the checksum.
+        # Jpegs will be validated when converting them to 1 band images
+        if False and icebridge_common.hasImageExtension(outputPath):
+            if outputPath in previouslyValid:
+                #logger.info('Previously validated: ' + outputPath)   # verbose
+                continue
+            else:
+                if not icebridge_common.isValidImage(outputPath):
+                    logger.info('Found an invalid image. Will wipe it: ' + outputPath)
+                    if os.path.exists(outputPath): os.remove(outputPath)
+                    failedFiles.append(outputPath)
                     continue
                 else:
-                    if not icebridge_common.isValidImage(outputPath):
-                        logger.info('Found an invalid image. Will wipe it: ' + outputPath)
-                        if os.path.exists(outputPath): os.remove(outputPath)
-                        failedFiles.append(outputPath)
-                        continue
-                    else:
-                        logger.info('Valid image: ' + outputPath)
-                        validFilesSet.add(outputPath) # mark it as validated
+                    logger.info('Valid image: ' + outputPath)
+                    validFilesSet.add(outputPath) # mark it as validated
+                    newStats[outputPath] = stats
 
         # Sanity check: XML files must have the right latitude.
-        if icebridge_common.fileExtension(outputPath) == '.xml':
-            if outputPath in validFilesSet and os.path.exists(outputPath):
+        if extension == '.xml':
+            if outputPath in previouslyValid:
                 #logger.info('Previously validated: ' + outputPath) #verbose
                 continue
             else:
@@ -826,6 +915,7 @@ def doFetch(options, outputFolder):
                         latitude = icebridge_common.parseLatitude(outputPath)
                         logger.info('Valid file: ' + outputPath)
                         validFilesSet.add(outputPath) # mark it as validated
+                        newStats[outputPath] = stats
                     except:
                         # Corrupted file
                         logger.info("Failed to parse latitude, will wipe: " + outputPath)
@@ -847,13 +937,14 @@ def doFetch(options, outputFolder):
                     #        os.remove(imageFile)
                     
         # Verify the chcksum    
-        if hasXml and len(outputPath) >= 4 and outputPath[-4:] != '.xml' \
-               and outputPath[-4:] != '.tfw':
-            if outputPath in validFilesSet and os.path.exists(outputPath):
+        if hasXml and extension not in ('.xml', '.tfw'):
+            if outputPath in previouslyValid:
                 #logger.info('Previously validated: ' + outputPath) # verbose
                 continue
             else:
-                isGood = icebridge_common.hasValidChkSum(outputPath, logger)
+                isGood = chkSumResults.get(outputPath)
+                if isGood is None:
+                    isGood = icebridge_common.hasValidChkSum(outputPath, logger)
                 if not isGood:
                     xmlFile = icebridge_common.xmlFile(outputPath)
                     logger.info('Found invalid data. Will wipe: ' + outputPath + ' ' + xmlFile)
@@ -865,9 +956,10 @@ def doFetch(options, outputFolder):
                 else:
                     logger.info('Valid file: ' + outputPath)
                     validFilesSet.add(outputPath)
+                    newStats[outputPath] = stats
 
-        if hasTfw and icebridge_common.fileExtension(outputPath) == '.tfw':
-            if outputPath in validFilesSet and os.path.exists(outputPath):
+        if hasTfw and extension == '.tfw':
+            if outputPath in previouslyValid:
                 #logger.info('Previously validated: ' + outputPath)
                 continue
             else:
@@ -883,6 +975,7 @@ def doFetch(options, outputFolder):
                 else:
                     logger.info('Valid tfw file: ' + outputPath)
                     validFilesSet.add(outputPath)
+                    newStats[outputPath] = stats
 
     # Write to disk the list of validated files, but only if new
     # validations happened.  First re-read that list, in case a
@@ -894,6 +987,13 @@ def doFetch(options, outputFolder):
                       icebridge_common.updateValidFilesListFromDisk(validFilesList, validFilesSet)
         icebridge_common.writeValidFilesList(validFilesList, validFilesSet)
 
+    # Record the state of the files validated in this run
+    if len(newStats) > 0:
+        # Re-read the manifest, in case another process modified it in the meantime
+        manifest = icebridge_common.readValidManifest(manifestFile)
+        manifest.update(newStats)
+        icebridge_common.writeValidManifest(manifestFile, manifest)
+
     numFailed = len(failedFiles)
     if numFailed > 0:
         logger.info("Number of files that could not be processed: " + str(numFailed))
@@ -949,6 +1049,9 @@ def main(argsIn):
         parser.add_option('--max-num-lidar-to-fetch', dest='maxNumLidarToFetch', default=-1,
                           type='int', help='The maximum number of lidar files to fetch. ' + \
                           'This is used in debugging.')
+        parser.add_option('--num-download-threads', dest='numDownloadThreads',
+                          default=NUM_DOWNLOAD_THREADS, type='int',
+                          help='How many curl downloads to run at the same time.')
 
         # This call handles all the parallel_mapproject specific options.
         (options, args) = parser.parse_args(argsIn)
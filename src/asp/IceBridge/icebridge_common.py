@@ -18,8 +18,8 @@
 
 # Icebridge utility functions
 
-import os, sys, datetime, time, subprocess, logging, re, hashlib, string
-import psutil, errno, getpass, glob
+import os, sys, datetime, time, subprocess, logging, re, hashlib, string, math
+import psutil, errno, getpass, glob, multiprocessing.pool, json
 
 # The path to the ASP python files
 basepath    = os.path.abspath(sys.path[0])
@@ -310,24 +310,86 @@ def writeValidFilesList(filesList, filesSet):
         for filename in sorted(filesSet):
             f.write(filename + '\n')
 
+def validManifestPrefix():
+    '''Must not start with validFilesPrefix(), as those files get merged as lists.'''
+    return 'valid_manifest'
+
+def validManifestFile(folder, startFrame, stopFrame):
+    '''File recording the size and modification time of each validated file,
+    so that files changed since validation can be caught. It sits next to
+    validFilesList() and uses the same range, for the same reason.
+    It is not archived, as restored files get new modification times.'''
+    
+    prefix = validManifestPrefix() + '_' + str(startFrame) + '_' + str(stopFrame) + '.json'
+    return os.path.join(folder, prefix)
+
+def fileStats(path):
+    '''The size and modification time of a file, as stored in the valid manifest.'''
+    stats = os.stat(path)
+    return [stats.st_size, stats.st_mtime]
+
+def readValidManifest(manifestFile):
+    '''Read the dictionary from file name to [size, mtime]. Return an empty
+    dictionary if the file is missing or corrupted.'''
+    if not os.path.exists(manifestFile):
+        return {}
+    try:
+        with open(manifestFile, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def writeValidManifest(manifestFile, manifest):
+    '''Write the dictionary from file name to [size, mtime] to disk.'''
+    print("Writing: " + manifestFile)
+
+    # Write to a temporary file and move it in place, so that
+    # a reader never sees a partially written manifest.
+    tempFile = manifestFile + '.tmp' + str(os.getpid())
+    with open(tempFile, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tempFile, manifestFile)
+
+def fileStatsInListing(path, folderListing):
+    '''Return fileStats() for a file in the set returned by listFolder()
+    for its folder, or None if the file is missing.'''
+    if os.path.basename(path) not in folderListing:
+        return None
+    try:
+        return fileStats(path)
+    except OSError:
+        return None # was wiped after the folder was listed
+
+def isPreviouslyValidated(path, stats, validFilesSet, manifest):
+    '''Return true if the file was validated before and still exists, given
+    its current stats from fileStats(), or None if missing. If its size and
+    modification time were recorded at validation, they must also not have
+    changed since then.'''
+    if stats is None or path not in validFilesSet:
+        return False
+    if path in manifest:
+        return manifest[path] == stats
+    return True
+
 def readIndexFile(parsedIndexPath, prependFolder = False):
     '''Read an index file having frame number, filename, and url it came from.'''
     frameDict  = {}
     urlDict    = {}
+    indexFolder = os.path.dirname(parsedIndexPath)
     with open(parsedIndexPath, 'r') as f:
         for line in f:
-            parts = line.strip().split(',')
+            parts = line.split(',', 2)
             if len(parts) < 3:
                 # Odd index file
                 raise Exception("Invalid index file: " + parsedIndexPath)
             
             frameNumber = int(parts[0])
-            frameDict[frameNumber] = parts[1].strip()
-
+            frameName   = parts[1].strip()
             if prependFolder:
-                frameDict[frameNumber] = os.path.join(os.path.dirname(parsedIndexPath),
-                                                      frameDict[frameNumber])
-            urlDict[frameNumber] = parts[2].strip()
+                frameName = os.path.join(indexFolder, frameName)
+                
+            frameDict[frameNumber] = frameName
+            urlDict[frameNumber]   = parts[2].strip()
 
     return (frameDict, urlDict)
 
@@ -796,7 +858,12 @@ def hasValidChkSum(filename, logger):
                     if chkSumCount == 1:
                         expectedChksum = m.group(1)
                     
-    actualChksum = hashlib.md5(open(filename,'rb').read()).hexdigest()
+    # Hash in chunks, as the files can be large and several may be hashed at once
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            md5.update(chunk)
+    actualChksum = md5.hexdigest()
 
     if actualChksum != expectedChksum or actualChksum == '' or expectedChksum == '':
         logger.info("Computed chksum: " + str(actualChksum) + " in " + filename)
@@ -806,6 +873,21 @@ def hasValidChkSum(filename, logger):
     
     return True
 
+def hasValidChkSumInParallel(filenames, numThreads, logger):
+    '''Run hasValidChkSum() on many files using a pool of threads. Reading
+       and hashing the files dominates here, and that does not hold the GIL.
+       Return a dictionary from each file name to its result.'''
+
+    if numThreads <= 1 or len(filenames) <= 1:
+        return dict((filename, hasValidChkSum(filename, logger)) for filename in filenames)
+
+    pool = multiprocessing.pool.ThreadPool(min(numThreads, len(filenames)))
+    results = pool.map(lambda filename: hasValidChkSum(filename, logger), filenames)
+    pool.close()
+    pool.join()
+    
+    return dict(zip(filenames, results))
+
 def isValidTfw(filename, logger):
     '''This file must have 6 lines of floats and a valid chksum.'''
     
@@ -1291,18 +1373,35 @@ def fileNonEmpty(path):
     '''Make sure file exists and is non-empty.'''
     return os.path.exists(path) and (os.path.getsize(path) > 0)
 
+def listFolder(folder):
+    '''Return the set of file names in a folder, or an empty set if it does not exist.'''
+    try:
+        return set(os.listdir(folder))
+    except OSError:
+        return set()
+
+def fileNonEmptyInListing(path, folderListing):
+    '''Same as fileNonEmpty(), but first look up the file name in the set
+    returned by listFolder() for its folder. Missing files then need no
+    system calls, and present ones need only one.'''
+    if os.path.basename(path) not in folderListing:
+        return False
+    try:
+        return os.path.getsize(path) > 0
+    except OSError:
+        return False # was wiped after the folder was listed
+
 def fetchFile(url, outputPath):
     '''Retrieve one file using curl.  Return True on success.'''
 
     # Set up the command
-    cookiePaths = ' -b ~/.urs_cookies -c ~/.urs_cookies '
-    curlOpts    = ' -n -L '
-    cmd = 'curl ' + cookiePaths + curlOpts + url + ' > ' + outputPath
+    cookiePath = os.path.expanduser('~/.urs_cookies')
+    cmd = ['curl', '-b', cookiePath, '-c', cookiePath, '-n', '-L', url]
 
     # Download the file
-    print cmd
-    p = subprocess.Popen(cmd, shell=True)
-    os.waitpid(p.pid, 0)
+    print " ".join(cmd) + ' > ' + outputPath
+    with open(outputPath, 'w') as f:
+        subprocess.call(cmd, stdout=f)
     
     return os.path.exists(outputPath)
 
@@ -1326,39 +1425,95 @@ def partitionArray(arr, wid):
         
     return out
     
+def runCurlCmd(curlArgs, outputFolder, logger):
+    '''Run one curl command, given as a list of arguments, in the given folder.
+       Return True on success.'''
+    # This can run from several threads at once. With Python 2 a child could
+    # then inherit the internal pipe of another thread's Popen and make it
+    # wait for an unrelated curl, unless all other descriptors are closed.
+    status = subprocess.call(curlArgs, cwd=outputFolder, close_fds=True)
+    if status != 0:
+        logger.info("Failed to run: " + " ".join(curlArgs))
+        return False
+    return True
+
+def withoutCookieJarUpdate(curlArgs):
+    '''Remove the '-c <cookie jar>' option from a list of curl arguments,
+       so that curl reads the cookies given with -b but does not write them back.'''
+    outArgs = []
+    skipNext = False
+    for arg in curlArgs:
+        if skipNext:
+            skipNext = False
+            continue
+        if arg == '-c':
+            skipNext = True
+            continue
+        outArgs.append(arg)
+    return outArgs
+
 # It is faster to invoke one curl command for multiple files.
 # Do not fetch files that already exist. Note that we expect
 # that each file looks like outputFolder/name.<ext>,
 # and each url looks like https://.../name.<ext>.
-def fetchFilesInBatches(baseCurlCmd, batchSize, dryRun, outputFolder, files, urls, logger):
-    '''Fetch a list of files in batches using curl.'''
+def fetchFilesInBatches(baseCurlArgs, batchSize, dryRun, outputFolder, files, urls, logger,
+                        numThreads = 1):
+    '''Fetch a list of files in batches using curl. The curl command and its
+       options are passed in as a list of arguments. If numThreads > 1,
+       run that many batches at the same time.'''
 
-    curlCmd = baseCurlCmd
     numFiles = len(files)
 
     if numFiles != len(urls):
         raise Exception("Expecting as many files as urls.")
-    
-    currentFileCount = 0
+
+    folderListing = listFolder(outputFolder)
+    urlsToFetch = []
     for fileIter in range(numFiles):
-        
-        if not fileNonEmpty(files[fileIter]):
-            # Add to the command
-            curlCmd += ' -O ' + urls[fileIter]
-            currentFileCount += 1 # Number of files in the current download command
-
-        # Download the indicated files when we hit the limit or run out of files
-        if ( (currentFileCount >= batchSize) or (fileIter == numFiles - 1) ) and \
-               currentFileCount > 0:
-            logger.info(curlCmd)
-            if not dryRun:
-                logger.info("Saving the data in " + outputFolder)
-                p = subprocess.Popen(curlCmd, cwd=outputFolder, shell=True)
-                os.waitpid(p.pid, 0)
-                
-            # Start command fresh for the next file
-            currentFileCount = 0
-            curlCmd = baseCurlCmd
+        if not fileNonEmptyInListing(files[fileIter], folderListing):
+            urlsToFetch.append(urls[fileIter])
+
+    if len(urlsToFetch) == 0:
+        return
+
+    # The downloads are network-bound, so make the batches small enough
+    # that each thread gets a share of the work.
+    if numThreads > 1:
+        batchSize = min(batchSize, int(math.ceil(float(len(urlsToFetch))/numThreads)))
+
+    batches = partitionArray(urlsToFetch, batchSize)
+    runInParallel = (numThreads > 1 and len(batches) > 1)
+
+    # Concurrent curl processes must not all rewrite the same cookie jar.
+    # With -b alone, each curl keeps any cookie updates in memory
+    # and does not write them back to the jar.
+    if runInParallel:
+        baseCurlArgs = withoutCookieJarUpdate(baseCurlArgs)
+    
+    curlCmds = []
+    for batch in batches:
+        curlCmd = baseCurlArgs[:]
+        for url in batch:
+            curlCmd += ['-O', url]
+        logger.info(" ".join(curlCmd))
+        curlCmds.append(curlCmd)
+
+    if dryRun:
+        return
+
+    logger.info("Saving the data in " + outputFolder)
+    if runInParallel:
+        pool = multiprocessing.pool.ThreadPool(min(numThreads, len(curlCmds)))
+        taskHandles = []
+        for curlCmd in curlCmds:
+            taskHandles.append(pool.apply_async(runCurlCmd, (curlCmd, outputFolder, logger)))
+        pool.close()
+        pool.join()
+        for taskHandle in taskHandles:
+            taskHandle.get() # propagate any exceptions
+    else:
+        for curlCmd in curlCmds:
+            runCurlCmd(curlCmd, outputFolder, logger)
     
 # This block of code is just to get a non-blocking keyboard check!
 import signal
@@ -387,6 +387,17 @@ def runConversion(run, options, conversionAttempt, logger):
             validFilesSet = icebridge_common.updateValidFilesListFromDisk(fileName, validFilesSet)
         icebridge_common.writeValidFilesList(validFilesList, validFilesSet)
 
+        # Same for the sizes and modification times of the validated files
+        manifestFile = icebridge_common.validManifestFile(outputFolder,
+                                                          options.startFrame, options.stopFrame)
+        manifest = icebridge_common.readValidManifest(manifestFile)
+        allManifests = glob.glob(os.path.join(outputFolder,
+                                              icebridge_common.validManifestPrefix() + '_*.json'))
+        for fileName in allManifests:
+            manifest.update(icebridge_common.readValidManifest(fileName))
+        if len(manifest) > 0:
+            icebridge_common.writeValidManifest(manifestFile, manifest)
+
         # Now we will refetch and reprocess all files that were not
         # valid so far. Hopefully not too many. This must be on a head
         # node to be able to access the network. We don't do any orthoconvert